@@ -9,6 +9,8 @@ Run:
 Notes:
  - This is a template. For real production: separate modules, DB migrations (Alembic), secrets manager, monitoring, TLS, improved rate-limiter & caching.
  - Ensure RAZORPAY_WEBHOOK_SECRET is set before enabling real webhooks.
+ - Optional DATABASE_READ_URL routes read-only handlers to a replica. Local stand-in:
+   DATABASE_READ_URL=sqlite:///./turbo_replica.db (copy turbo.db over it to "replicate").
 """
 
 import os
@@ -18,8 +20,9 @@ import hmac
 import hashlib
 import logging
 import asyncio
+import threading
 from typing import Optional, Dict, Any, List
-from datetime import datetime
+from datetime import datetime, timedelta
 
 import requests
 import razorpay
@@ -28,6 +31,9 @@ from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from sqlmodel import SQLModel, Field, create_engine, Session, select
+from sqlalchemy import Index, and_, func, inspect, or_, text, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from passlib.context import CryptContext
 
 # ---------------------------
@@ -43,6 +49,8 @@ logger = logging.getLogger("turbo-backend")
 # Config (env)
 # ---------------------------
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./turbo.db")
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL", "")
+READ_YOUR_WRITES_SEC = float(os.getenv("READ_YOUR_WRITES_SEC", "5"))
 RAZORPAY_KEY = os.getenv("RAZORPAY_KEY", "")
 RAZORPAY_SECRET = os.getenv("RAZORPAY_SECRET", "")
 RAZORPAY_WEBHOOK_SECRET = os.getenv("RAZORPAY_WEBHOOK_SECRET", "")
@@ -50,12 +58,27 @@ ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "admintoken123")
 SIGNUP_FREE_CREDIT = float(os.getenv("SIGNUP_FREE_CREDIT", "20.0"))
 REFERRAL_BONUS = float(os.getenv("REFERRAL_BONUS", "50.0"))
 RATE_LIMIT_PER_MIN = int(os.getenv("RATE_LIMIT_PER_MIN", "30"))
+RECON_INTERVAL_SEC = int(os.getenv("RECON_INTERVAL_SEC", "300"))
+RECON_BATCH_SIZE = int(os.getenv("RECON_BATCH_SIZE", "500"))
+RECON_TOLERANCE = float(os.getenv("RECON_TOLERANCE", "0.01"))
+RECON_RESCAN_WINDOW = int(os.getenv("RECON_RESCAN_WINDOW", "1000"))
+ARCHIVE_INTERVAL_SEC = int(os.getenv("ARCHIVE_INTERVAL_SEC", "3600"))
+ARCHIVE_INSTANCE_AFTER_DAYS = int(os.getenv("ARCHIVE_INSTANCE_AFTER_DAYS", "7"))
+ARCHIVE_PENDING_AFTER_DAYS = int(os.getenv("ARCHIVE_PENDING_AFTER_DAYS", "30"))
+ARCHIVE_TX_AFTER_DAYS = int(os.getenv("ARCHIVE_TX_AFTER_DAYS", "180"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "1000"))
+LEADERBOARD_SIZE = int(os.getenv("LEADERBOARD_SIZE", "100"))
+LEADERBOARD_REFRESH_SEC = int(os.getenv("LEADERBOARD_REFRESH_SEC", "60"))
 
 # ---------------------------
 # DB & password hasher
 # ---------------------------
-connect_args = {"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {}
-engine = create_engine(DATABASE_URL, echo=False, connect_args=connect_args)
+def make_engine(url: str):
+    connect_args = {"check_same_thread": False} if url.startswith("sqlite") else {}
+    return create_engine(url, echo=False, connect_args=connect_args)
+
+engine = make_engine(DATABASE_URL)
+read_engine = make_engine(DATABASE_READ_URL) if DATABASE_READ_URL else engine
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
 # ---------------------------
@@ -75,14 +98,21 @@ class WalletBalance(SQLModel, table=True):
     user_id: int
     balance: float = 0.0
 
+# sqlite_autoincrement: archived (deleted) ids must never be handed out again (new DBs only)
 class WalletTransaction(SQLModel, table=True):
+    __table_args__ = {"sqlite_autoincrement": True}
     id: Optional[int] = Field(default=None, primary_key=True)
-    user_id: int
+    user_id: int = Field(index=True)
     amount: float
     note: str = ""
-    created_at: datetime = Field(default_factory=datetime.utcnow)
+    created_at: datetime = Field(default_factory=datetime.utcnow, index=True)
 
 class Instance(SQLModel, table=True):
+    __table_args__ = (
+        Index("ix_instance_status_created_at", "status", "created_at"),
+        Index("ix_instance_status_terminated_at", "status", "terminated_at"),
+        {"sqlite_autoincrement": True},
+    )
     id: Optional[int] = Field(default=None, primary_key=True)
     user_id: int
     provider_instance_id: Optional[str] = None
@@ -90,9 +120,129 @@ class Instance(SQLModel, table=True):
     ip: Optional[str] = None
     raw: Optional[str] = None
     created_at: datetime = Field(default_factory=datetime.utcnow)
+    terminated_at: Optional[datetime] = None
+
+class ReconCheckpoint(SQLModel, table=True):
+    # high-water mark of the ledger reconciliation job (one row per job name)
+    id: Optional[int] = Field(default=None, primary_key=True)
+    name: str = Field(index=True)
+    last_tx_id: int = 0
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+class ReconDiscrepancy(SQLModel, table=True):
+    # open balance/ledger mismatches; a row is removed once the user reconciles again
+    id: Optional[int] = Field(default=None, primary_key=True)
+    user_id: int = Field(index=True, unique=True)
+    balance: float = 0.0
+    ledger_sum: float = 0.0
+    diff: float = 0.0
+    first_seen_at: datetime = Field(default_factory=datetime.utcnow)
+    last_checked_at: datetime = Field(default_factory=datetime.utcnow)
+
+# cold storage: own surrogate id, hot-table id kept in source_id (may repeat on old SQLite DBs)
+class InstanceArchive(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    source_id: int = Field(index=True)
+    user_id: int = Field(index=True)
+    provider_instance_id: Optional[str] = None
+    status: str = "terminated"
+    ip: Optional[str] = None
+    raw: Optional[str] = None
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    terminated_at: Optional[datetime] = None
+    archived_at: datetime = Field(default_factory=datetime.utcnow)
+
+class WalletTransactionArchive(SQLModel, table=True):
+    id: Optional[int] = Field(default=None, primary_key=True)
+    source_id: int = Field(index=True)
+    user_id: int = Field(index=True)
+    amount: float
+    note: str = ""
+    created_at: datetime = Field(default_factory=datetime.utcnow)
+    archived_at: datetime = Field(default_factory=datetime.utcnow)
+
+class ReferralStats(SQLModel, table=True):
+    # per-referrer counters, bumped in signup and the webhook bonus path
+    id: Optional[int] = Field(default=None, primary_key=True)
+    user_id: int = Field(index=True, unique=True)
+    referrals_count: int = 0
+    paid_referrals_count: int = 0
+    bonus_earned: float = 0.0
+    updated_at: datetime = Field(default_factory=datetime.utcnow)
+
+class LedgerArchiveSummary(SQLModel, table=True):
+    # per-user running total of archived transactions, so reconciliation never scans the archive
+    id: Optional[int] = Field(default=None, primary_key=True)
+    user_id: int = Field(index=True, unique=True)
+    archived_sum: float = 0.0
+    archived_count: int = 0
 
 # create tables
 SQLModel.metadata.create_all(engine)
+# create_all never alters existing tables; add nullable columns introduced after the first deploy
+_added_columns = {"instance": ["terminated_at"]}
+for _table_name, _columns in _added_columns.items():
+    _existing = {c["name"] for c in inspect(engine).get_columns(_table_name)}
+    for _column in _columns:
+        if _column not in _existing:
+            _type = SQLModel.metadata.tables[_table_name].c[_column].type.compile(dialect=engine.dialect)
+            with engine.begin() as _conn:
+                _conn.execute(text(f"ALTER TABLE {_table_name} ADD COLUMN {_column} {_type}"))
+# create_all skips indexes on tables that already exist; add any new ones in place
+for _table in SQLModel.metadata.sorted_tables:
+    for _index in _table.indexes:
+        _index.create(engine, checkfirst=True)
+if read_engine is not engine and DATABASE_READ_URL.startswith("sqlite"):
+    # local replica stand-in only; a real replica gets its schema from the primary
+    SQLModel.metadata.create_all(read_engine)
+
+# ---------------------------
+# DB helpers
+# ---------------------------
+def upsert_row(session: Session, model, key: str, values: Dict[str, Any], set_: Dict[str, Any]):
+    """
+    INSERT values, or UPDATE set_ when a row with the same unique `key` exists, in one statement
+    on Postgres/SQLite (ON CONFLICT DO UPDATE); other dialects fall back to UPDATE-then-INSERT.
+    set_ may reference the current row through model.__table__.c.
+    """
+    table = model.__table__
+    dialect = session.get_bind().dialect.name
+    if dialect in ("postgresql", "sqlite"):
+        insert = pg_insert if dialect == "postgresql" else sqlite_insert
+        session.execute(insert(table).values(**values).on_conflict_do_update(index_elements=[table.c[key]], set_=set_))
+        return
+    result = session.execute(update(table).where(table.c[key] == values[key]).values(**set_))
+    if result.rowcount == 0:
+        session.execute(table.insert().values(**values))
+
+# ---------------------------
+# Read/write session routing
+# ---------------------------
+# user_id -> time of that user's last write; per-process like the rate limiter (run with --workers 1)
+_recent_writes: Dict[int, float] = {}
+
+def mark_user_write(user_id: Optional[int]):
+    if not user_id:
+        return
+    now = time.time()
+    _recent_writes[user_id] = now
+    if len(_recent_writes) > 10000:
+        for uid, ts in list(_recent_writes.items()):
+            if now - ts >= READ_YOUR_WRITES_SEC:
+                _recent_writes.pop(uid, None)
+
+def read_session(user_id: Optional[int] = None) -> Session:
+    """
+    Session for read-only handlers: replica when configured, but the primary for a user
+    who wrote within READ_YOUR_WRITES_SEC so they always see their own writes.
+    """
+    if read_engine is engine:
+        return Session(engine)
+    if user_id is not None:
+        ts = _recent_writes.get(user_id)
+        if ts and time.time() - ts < READ_YOUR_WRITES_SEC:
+            return Session(engine)
+    return Session(read_engine)
 
 # ---------------------------
 # Razorpay client init
@@ -161,19 +311,35 @@ def generate_referral_code(user_id: int) -> str:
     stamp = str(int(time.time()))[-4:]
     return f"TC-{user_id}-{stamp}"
 
-def get_user_by_token(authorization: Optional[str] = Header(None)) -> User:
+def _token_user_id(authorization: Optional[str]) -> int:
     if not authorization:
         raise HTTPException(status_code=401, detail="Missing authorization")
     token = authorization.replace("Bearer ", "")
     uid = decode_token(token)
     if not uid:
         raise HTTPException(status_code=401, detail="Invalid token")
+    return uid
+
+def get_user_by_token(authorization: Optional[str] = Header(None)) -> User:
+    uid = _token_user_id(authorization)
     with Session(engine) as session:
         user = session.get(User, uid)
         if not user:
             raise HTTPException(status_code=401, detail="User not found")
         return user
 
+def get_user_by_token_read(authorization: Optional[str] = Header(None)) -> User:
+    # read-only handlers only: replica lookup, primary if the user hasn't replicated yet
+    uid = _token_user_id(authorization)
+    with read_session(uid) as session:
+        user = session.get(User, uid)
+    if not user and read_engine is not engine:
+        with Session(engine) as session:
+            user = session.get(User, uid)
+    if not user:
+        raise HTTPException(status_code=401, detail="User not found")
+    return user
+
 # ---------------------------
 # Verify razorpay signature
 # ---------------------------
@@ -236,8 +402,11 @@ def telegram_send(text: str) -> bool:
 async def background_poll_loop():
     while True:
         try:
-            with Session(engine) as session:
-                instances = session.exec(select(Instance).where(Instance.provider_instance_id != None)).all()
+            with read_session() as session:
+                instances = session.exec(select(Instance).where(
+                    Instance.provider_instance_id != None,
+                    Instance.status != "terminated"
+                )).all()
                 for inst in instances:
                     # placeholder: call provider API to get real status
                     # For now just log
@@ -247,10 +416,364 @@ async def background_poll_loop():
             logger.exception("background poll error: %s", e)
             await asyncio.sleep(5)
 
+# ---------------------------
+# Ledger reconciliation (incremental, checkpointed)
+# ---------------------------
+RECON_JOB_NAME = "wallet_ledger"
+
+# reconciliation and archiving both touch the ledger split (hot rows vs archive summary)
+_ledger_lock = threading.Lock()
+
+_recon_metrics: Dict[str, Any] = {
+    "runs": 0,
+    "last_run_at": None,
+    "last_duration_sec": 0.0,
+    "last_users_checked": 0,
+    "last_rows_scanned": 0,
+    "last_rows_per_sec": 0.0,
+    "last_tx_id": 0,
+    "last_pending": 0,
+    "discrepancies": [],
+}
+
+# users whose ledger was still moving when checked; re-checked on the next run
+_recon_pending: set = set()
+
+def _get_recon_checkpoint(session: Session) -> ReconCheckpoint:
+    cp = session.exec(select(ReconCheckpoint).where(ReconCheckpoint.name == RECON_JOB_NAME)).first()
+    if not cp:
+        cp = ReconCheckpoint(name=RECON_JOB_NAME, last_tx_id=0)
+        session.add(cp); session.commit(); session.refresh(cp)
+    return cp
+
+def run_reconciliation() -> Dict[str, Any]:
+    with _ledger_lock:
+        return _run_reconciliation()
+
+def _recheck_user(uid: int) -> Optional[tuple]:
+    """
+    Re-read one user's balance and ledger on the primary, bracketing the SUM with two balance reads.
+    Balance and ledger row are always committed together, so a write landing mid-check changes
+    either the balance or the row count. Returns (balance, ledger_sum), or None while still moving.
+    """
+    with Session(engine) as session:
+        def balance() -> float:
+            wb = session.exec(select(WalletBalance).where(WalletBalance.user_id == uid)).first()
+            return wb.balance if wb else 0.0
+
+        def ledger() -> tuple:
+            total, count = session.exec(select(
+                func.sum(WalletTransaction.amount), func.count(WalletTransaction.id)
+            ).where(WalletTransaction.user_id == uid)).one()
+            return float(total or 0.0), count
+
+        before = balance()
+        hot_sum, count = ledger()
+        after = balance()
+        if before != after or ledger()[1] != count:
+            return None
+        summary = session.exec(select(LedgerArchiveSummary).where(LedgerArchiveSummary.user_id == uid)).first()
+        return after, hot_sum + (summary.archived_sum if summary else 0.0)
+
+def _run_reconciliation() -> Dict[str, Any]:
+    """
+    Verify WalletBalance.balance == SUM(WalletTransaction.amount) + archived sum for every user whose ledger
+    got new rows since the last checkpoint (re-scanning RECON_RESCAN_WINDOW ids below it for late commits),
+    plus every user with an open discrepancy, then advance the checkpoint to the newest tx id seen.
+    The batch reads are not one snapshot, so every mismatch is confirmed with _recheck_user before it
+    is recorded; users still being written to are left pending for the next run.
+    Open discrepancies persist in ReconDiscrepancy until a later check finds the user balanced.
+    """
+    started = time.time()
+    rows_scanned = 0
+    new_discrepancies: List[Dict[str, Any]] = []
+    pending = set()
+    with Session(engine) as session:
+        cp = _get_recon_checkpoint(session)
+        since = max(0, cp.last_tx_id - RECON_RESCAN_WINDOW)
+        high_water = session.exec(select(func.max(WalletTransaction.id))).one() or cp.last_tx_id
+        changed = session.exec(select(WalletTransaction.user_id).where(
+            WalletTransaction.id > since,
+            WalletTransaction.id <= high_water
+        ).distinct()).all()
+        open_rows = {d.user_id: d for d in session.exec(select(ReconDiscrepancy)).all()}
+        user_ids = sorted(set(changed) | set(open_rows) | _recon_pending)
+
+        for i in range(0, len(user_ids), RECON_BATCH_SIZE):
+            batch = user_ids[i:i + RECON_BATCH_SIZE]
+            sums = {
+                uid: (float(total or 0.0), count)
+                for uid, total, count in session.exec(select(
+                    WalletTransaction.user_id,
+                    func.sum(WalletTransaction.amount),
+                    func.count(WalletTransaction.id)
+                ).where(WalletTransaction.user_id.in_(batch)).group_by(WalletTransaction.user_id)).all()
+            }
+            balances = {
+                wb.user_id: wb.balance
+                for wb in session.exec(select(WalletBalance).where(WalletBalance.user_id.in_(batch))).all()
+            }
+            archived = {
+                a.user_id: a.archived_sum
+                for a in session.exec(select(LedgerArchiveSummary).where(LedgerArchiveSummary.user_id.in_(batch))).all()
+            }
+            now = datetime.utcnow()
+            for uid in batch:
+                hot_sum, count = sums.get(uid, (0.0, 0))
+                rows_scanned += count
+                balance = balances.get(uid, 0.0)
+                ledger_sum = hot_sum + archived.get(uid, 0.0)
+                existing = open_rows.get(uid)
+                if abs(balance - ledger_sum) > RECON_TOLERANCE:
+                    confirmed = _recheck_user(uid)
+                    if confirmed is None:
+                        pending.add(uid)
+                        continue
+                    balance, ledger_sum = confirmed
+                if abs(balance - ledger_sum) <= RECON_TOLERANCE:
+                    if existing:
+                        session.delete(existing)
+                        logger.info("Reconciliation: user %s balanced again", uid)
+                    continue
+                d = existing or ReconDiscrepancy(user_id=uid, first_seen_at=now)
+                d.balance = balance
+                d.ledger_sum = round(ledger_sum, 2)
+                d.diff = round(balance - ledger_sum, 2)
+                d.last_checked_at = now
+                session.add(d)
+                if not existing:
+                    new_discrepancies.append({"user_id": uid, "balance": balance, "ledger_sum": d.ledger_sum, "diff": d.diff})
+
+        cp.last_tx_id = high_water
+        cp.updated_at = datetime.utcnow()
+        session.add(cp); session.commit()
+        open_now = [d.dict() for d in session.exec(select(ReconDiscrepancy).order_by(ReconDiscrepancy.user_id)).all()]
+    _recon_pending.clear()
+    _recon_pending.update(pending)
+
+    elapsed = time.time() - started
+    _recon_metrics.update({
+        "runs": _recon_metrics["runs"] + 1,
+        "last_run_at": datetime.utcnow().isoformat(),
+        "last_duration_sec": round(elapsed, 3),
+        "last_users_checked": len(user_ids),
+        "last_rows_scanned": rows_scanned,
+        "last_rows_per_sec": round(rows_scanned / elapsed, 1) if elapsed > 0 else 0.0,
+        "last_tx_id": high_water,
+        "last_pending": len(pending),
+        "discrepancies": open_now,
+    })
+    if new_discrepancies:
+        logger.warning("Reconciliation found %s new wallet discrepancies: %s", len(new_discrepancies), new_discrepancies[:10])
+        telegram_send(f"Wallet reconciliation: {len(new_discrepancies)} new discrepancies (first: {new_discrepancies[0]})")
+    logger.info("Reconciliation: %s users, %s rows in %.3fs, %s open discrepancies, %s pending",
+                len(user_ids), rows_scanned, elapsed, len(open_now), len(pending))
+    return _recon_metrics
+
+async def background_reconcile_loop():
+    while True:
+        try:
+            await asyncio.to_thread(run_reconciliation)
+        except Exception as e:
+            logger.exception("reconciliation error: %s", e)
+        await asyncio.sleep(RECON_INTERVAL_SEC)
+
+# ---------------------------
+# Hot/cold tiering: move terminated instances and old transactions to archive tables
+# ---------------------------
+_archive_metrics: Dict[str, Any] = {
+    "runs": 0,
+    "last_run_at": None,
+    "last_duration_sec": 0.0,
+    "last_instances_archived": 0,
+    "last_transactions_archived": 0,
+}
+
+def _archive_instances(session: Session, condition, status: Optional[str] = None) -> int:
+    moved = 0
+    while True:
+        rows = session.exec(select(Instance).where(condition).order_by(Instance.id).limit(ARCHIVE_BATCH_SIZE)).all()
+        if not rows:
+            return moved
+        now = datetime.utcnow()
+        for inst in rows:
+            data = inst.dict()
+            data["source_id"] = data.pop("id")
+            if status:
+                data["status"] = status
+            session.add(InstanceArchive(**data, archived_at=now))
+            session.delete(inst)
+        session.commit()
+        moved += len(rows)
+
+def _archive_transactions(session: Session, cutoff: datetime) -> int:
+    moved = 0
+    while True:
+        rows = session.exec(select(WalletTransaction).where(
+            WalletTransaction.created_at < cutoff
+        ).order_by(WalletTransaction.id).limit(ARCHIVE_BATCH_SIZE)).all()
+        if not rows:
+            return moved
+        now = datetime.utcnow()
+        per_user: Dict[int, List[float]] = {}
+        for tx in rows:
+            data = tx.dict()
+            data["source_id"] = data.pop("id")
+            session.add(WalletTransactionArchive(**data, archived_at=now))
+            session.delete(tx)
+            per_user.setdefault(tx.user_id, []).append(tx.amount)
+        summary = LedgerArchiveSummary.__table__
+        for uid, amounts in per_user.items():
+            upsert_row(session, LedgerArchiveSummary, "user_id",
+                       {"user_id": uid, "archived_sum": sum(amounts), "archived_count": len(amounts)},
+                       {"archived_sum": summary.c.archived_sum + sum(amounts),
+                        "archived_count": summary.c.archived_count + len(amounts)})
+        # archive copy, hot delete and summary bump land in one commit
+        session.commit()
+        moved += len(rows)
+
+def run_archive() -> Dict[str, Any]:
+    """
+    Terminated instances move to the archive ARCHIVE_INSTANCE_AFTER_DAYS after terminated_at
+    (created_at for rows terminated before that column existed). Pending instances never got a
+    provider id or a charge; after ARCHIVE_PENDING_AFTER_DAYS they are archived as "expired".
+    Transactions move once created_at is older than ARCHIVE_TX_AFTER_DAYS.
+    """
+    started = time.time()
+    now = datetime.utcnow()
+    terminated_cutoff = now - timedelta(days=ARCHIVE_INSTANCE_AFTER_DAYS)
+    with _ledger_lock, Session(engine) as session:
+        instances = _archive_instances(session, and_(
+            Instance.status == "terminated",
+            or_(
+                Instance.terminated_at < terminated_cutoff,
+                and_(Instance.terminated_at == None, Instance.created_at < terminated_cutoff)
+            )
+        ))
+        instances += _archive_instances(session, and_(
+            Instance.status == "pending",
+            Instance.created_at < now - timedelta(days=ARCHIVE_PENDING_AFTER_DAYS)
+        ), status="expired")
+        transactions = _archive_transactions(session, now - timedelta(days=ARCHIVE_TX_AFTER_DAYS))
+    elapsed = time.time() - started
+    _archive_metrics.update({
+        "runs": _archive_metrics["runs"] + 1,
+        "last_run_at": now.isoformat(),
+        "last_duration_sec": round(elapsed, 3),
+        "last_instances_archived": instances,
+        "last_transactions_archived": transactions,
+    })
+    logger.info("Archived %s instances and %s transactions in %.3fs", instances, transactions, elapsed)
+    return _archive_metrics
+
+async def background_archive_loop():
+    while True:
+        try:
+            await asyncio.to_thread(run_archive)
+        except Exception as e:
+            logger.exception("archive error: %s", e)
+        await asyncio.sleep(ARCHIVE_INTERVAL_SEC)
+
+# ---------------------------
+# Referral stats: incremental counters + cached leaderboard snapshot
+# ---------------------------
+def bump_referral_stats(session: Session, referrer_id: int, referrals: int = 0, paid: int = 0, bonus: float = 0.0):
+    """Atomically add to a referrer's counters; caller commits together with the change that caused it."""
+    now = datetime.utcnow()
+    table = ReferralStats.__table__
+    # single-statement upsert: concurrent first referrals can't collide on the unique user_id
+    upsert_row(session, ReferralStats, "user_id",
+               {"user_id": referrer_id, "referrals_count": referrals, "paid_referrals_count": paid,
+                "bonus_earned": bonus, "updated_at": now},
+               {"referrals_count": table.c.referrals_count + referrals,
+                "paid_referrals_count": table.c.paid_referrals_count + paid,
+                "bonus_earned": table.c.bonus_earned + bonus,
+                "updated_at": now})
+
+_leaderboard_cache: Dict[str, Any] = {"rows": [], "refreshed_at": None, "ts": 0.0}
+
+def _mask_name(name: Optional[str]) -> str:
+    name = (name or "").strip()
+    return f"{name[0]}***" if name else "anonymous"
+
+def refresh_leaderboard() -> Dict[str, Any]:
+    with read_session() as session:
+        rows = session.exec(select(ReferralStats, User.name).join(User, User.id == ReferralStats.user_id).where(
+            ReferralStats.referrals_count > 0
+        ).order_by(
+            ReferralStats.referrals_count.desc(),
+            ReferralStats.bonus_earned.desc()
+        ).limit(LEADERBOARD_SIZE)).all()
+        snapshot = [{
+            "rank": i + 1,
+            "user_id": st.user_id,
+            "name": _mask_name(name),
+            "referrals": st.referrals_count,
+            "paid_referrals": st.paid_referrals_count,
+            "bonus_earned": round(st.bonus_earned, 2),
+        } for i, (st, name) in enumerate(rows)]
+    _leaderboard_cache.update({"rows": snapshot, "refreshed_at": datetime.utcnow().isoformat(), "ts": time.time()})
+    return _leaderboard_cache
+
+def rebuild_referral_stats() -> int:
+    """
+    One-off backfill from User.referred_by and the referral_bonus_from_user_<id> notes
+    (hot + archived ledger). Full scans - admin use only; normal traffic keeps counters incrementally.
+    Rows are upserted in place, so concurrent signups/webhooks never fail on the unique user_id,
+    but a bump landing between the scans and the commit is overwritten by the recomputed value:
+    run it while signup and payment traffic is stopped.
+    """
+    bonus_note = "referral_bonus_from_user_%"
+    with _ledger_lock, Session(engine) as session:
+        stats: Dict[int, Dict[str, Any]] = {}
+
+        def row(uid: int) -> Dict[str, Any]:
+            return stats.setdefault(uid, {"referrals_count": 0, "paid_referrals_count": 0, "bonus_earned": 0.0})
+
+        for ref_id, count in session.exec(select(User.referred_by, func.count(User.id)).where(
+            User.referred_by != None
+        ).group_by(User.referred_by)).all():
+            row(ref_id)["referrals_count"] = count
+        for table in (WalletTransaction, WalletTransactionArchive):
+            for uid, count, total in session.exec(select(table.user_id, func.count(table.id), func.sum(table.amount)).where(
+                table.note.like(bonus_note)
+            ).group_by(table.user_id)).all():
+                row(uid)["paid_referrals_count"] += count
+                row(uid)["bonus_earned"] += float(total or 0.0)
+
+        now = datetime.utcnow()
+        for uid, values in stats.items():
+            values = {**values, "updated_at": now}
+            upsert_row(session, ReferralStats, "user_id", {"user_id": uid, **values}, values)
+        # referrers with no remaining evidence drop to zero instead of being deleted
+        session.execute(update(ReferralStats).where(ReferralStats.user_id.notin_(list(stats))).values(
+            referrals_count=0, paid_referrals_count=0, bonus_earned=0.0, updated_at=now
+        ))
+        session.commit()
+    refresh_leaderboard()
+    return len(stats)
+
+async def background_leaderboard_loop():
+    while True:
+        try:
+            await asyncio.to_thread(refresh_leaderboard)
+        except Exception as e:
+            logger.exception("leaderboard refresh error: %s", e)
+        await asyncio.sleep(LEADERBOARD_REFRESH_SEC)
+
 @app.on_event("startup")
 async def startup_event():
     asyncio.create_task(background_poll_loop())
     logger.info("Background poller started")
+    if RECON_INTERVAL_SEC > 0:
+        asyncio.create_task(background_reconcile_loop())
+        logger.info("Ledger reconciliation started (every %ss)", RECON_INTERVAL_SEC)
+    if ARCHIVE_INTERVAL_SEC > 0:
+        asyncio.create_task(background_archive_loop())
+        logger.info("Archiver started (every %ss)", ARCHIVE_INTERVAL_SEC)
+    if LEADERBOARD_REFRESH_SEC > 0:
+        asyncio.create_task(background_leaderboard_loop())
+        logger.info("Leaderboard refresher started (every %ss)", LEADERBOARD_REFRESH_SEC)
 
 # ----------------------
 # Auth endpoints
@@ -313,6 +836,7 @@ def signup(req: SignupRequest):
                 ref_user = session.get(User, ref_id)
                 if ref_user:
                     user.referred_by = ref_id
+                    bump_referral_stats(session, ref_id, referrals=1)
 
         # update user with referral & generate referral
         user.referral_code = generate_referral_code(user.id)
@@ -339,6 +863,7 @@ def signup(req: SignupRequest):
         except Exception as e:
             logger.exception("create wallet transaction failed: %s", e)
 
+        mark_user_write(user.id)
         # create token and return
         token = create_token(user.id)
         return {
@@ -379,9 +904,13 @@ def login(req: LoginRequest):
 # Wallet endpoints
 # ---------------------------
 @app.get("/wallet")
-def get_wallet(user: User = Depends(get_user_by_token)):
+def get_wallet(user: User = Depends(get_user_by_token_read)):
     if not check_rate_limit(f"user-{user.id}"):
         raise HTTPException(status_code=429, detail="Too many requests")
+    with read_session(user.id) as session:
+        wb = session.exec(select(WalletBalance).where(WalletBalance.user_id == user.id)).first()
+        if wb:
+            return {"balance": wb.balance}
     with Session(engine) as session:
         wb = session.exec(select(WalletBalance).where(WalletBalance.user_id == user.id)).first()
         if not wb:
@@ -389,6 +918,7 @@ def get_wallet(user: User = Depends(get_user_by_token)):
             session.add(wb)
             session.commit()
             session.refresh(wb)
+            mark_user_write(user.id)
         return {"balance": wb.balance}
 
 @app.post("/wallet/create-order")
@@ -469,6 +999,7 @@ async def razorpay_webhook(request: Request):
                 wb.balance += amt
                 tx = WalletTransaction(user_id=uid, amount=amt, note="razorpay_payment")
                 session.add(tx); session.add(wb); session.commit()
+                mark_user_write(uid)
 
                 logger.info("Credited user %s amount ₹%s via webhook", uid, amt)
 
@@ -489,7 +1020,9 @@ async def razorpay_webhook(request: Request):
                             rwb.balance += REFERRAL_BONUS
                             session.add(WalletTransaction(user_id=ref.id, amount=REFERRAL_BONUS, note=f"referral_bonus_from_user_{user.id}"))
                             user.referral_bonus_given = True
+                            bump_referral_stats(session, ref.id, paid=1, bonus=REFERRAL_BONUS)
                             session.add(user); session.add(rwb); session.commit()
+                            mark_user_write(ref.id)
                             logger.info("Awarded referral bonus ₹%s to user %s because %s paid", REFERRAL_BONUS, ref.id, user.id)
                 return {"status": "ok"}
         else:
@@ -515,6 +1048,34 @@ def webhook_simulate(user_id: int = Body(...), amount: float = Body(...)):
     resp = loop.run_until_complete(razorpay_webhook(DummyReq()))
     return {"simulated": resp}
 
+# ---------------------------
+# Referral endpoints
+# ---------------------------
+@app.get("/referrals/me")
+def referrals_me(user: User = Depends(get_user_by_token_read)):
+    if not check_rate_limit(f"user-{user.id}"):
+        raise HTTPException(status_code=429, detail="Too many requests")
+    with read_session(user.id) as session:
+        st = session.exec(select(ReferralStats).where(ReferralStats.user_id == user.id)).first()
+        return {
+            "referral_code": user.referral_code,
+            "referrals": st.referrals_count if st else 0,
+            "paid_referrals": st.paid_referrals_count if st else 0,
+            "bonus_earned": round(st.bonus_earned, 2) if st else 0.0,
+        }
+
+@app.get("/referrals/leaderboard")
+def referrals_leaderboard(limit: int = 10, user: User = Depends(get_user_by_token_read)):
+    if not check_rate_limit(f"user-{user.id}"):
+        raise HTTPException(status_code=429, detail="Too many requests")
+    # served from the periodically refreshed snapshot; user ids never leave the server
+    limit = max(1, min(limit, LEADERBOARD_SIZE))
+    rows = [
+        {**{k: v for k, v in r.items() if k != "user_id"}, "is_me": r["user_id"] == user.id}
+        for r in _leaderboard_cache["rows"][:limit]
+    ]
+    return {"leaderboard": rows, "refreshed_at": _leaderboard_cache["refreshed_at"]}
+
 # ---------------------------
 # Instances (simplified)
 # ---------------------------
@@ -528,6 +1089,7 @@ def create_instance(req: CreateInstanceRequest, user: User = Depends(get_user_by
         if not wb or wb.balance < estimated_price:
             inst = Instance(user_id=user.id, status="pending")
             session.add(inst); session.commit(); session.refresh(inst)
+            mark_user_write(user.id)
             return {"status": "insufficient_balance", "required": estimated_price, "instance_id": inst.id}
         # deduct estimated
         wb.balance -= estimated_price
@@ -537,17 +1099,35 @@ def create_instance(req: CreateInstanceRequest, user: User = Depends(get_user_by
         inst = Instance(user_id=user.id, status="running", provider_instance_id=f"virt-{int(time.time())}")
         session.add(inst)
         session.commit(); session.refresh(inst)
+        mark_user_write(user.id)
         return {"status": "created", "id": inst.id, "estimated_charged": estimated_price}
 
+def _find_instance_status(session: Session, instance_id: int, user_id: int):
+    """(response, other_owner) for the caller's hot or archived instance; response is None if not found."""
+    inst = session.get(Instance, instance_id)
+    if inst and inst.user_id == user_id:
+        return {"id": inst.id, "status": inst.status, "ip": inst.ip}, False
+    archived = session.exec(select(InstanceArchive).where(
+        InstanceArchive.source_id == instance_id,
+        InstanceArchive.user_id == user_id
+    ).order_by(InstanceArchive.id.desc())).first()
+    if archived:
+        return {"id": archived.source_id, "status": archived.status, "ip": archived.ip}, False
+    return None, inst is not None
+
 @app.get("/status/{instance_id}")
-def get_status(instance_id: int, user: User = Depends(get_user_by_token)):
-    with Session(engine) as session:
-        inst = session.get(Instance, instance_id)
-        if not inst:
-            raise HTTPException(status_code=404, detail="Instance not found")
-        if inst.user_id != user.id:
-            raise HTTPException(status_code=403, detail="Forbidden")
-        return {"id": inst.id, "status": inst.status, "ip": inst.ip}
+def get_status(instance_id: int, user: User = Depends(get_user_by_token_read)):
+    with read_session(user.id) as session:
+        found, other_owner = _find_instance_status(session, instance_id, user.id)
+    if not found and read_engine is not engine:
+        # replica may lag behind the user's own create/terminate/archive; the primary decides
+        with Session(engine) as session:
+            found, other_owner = _find_instance_status(session, instance_id, user.id)
+    if found:
+        return found
+    if other_owner:
+        raise HTTPException(status_code=403, detail="Forbidden")
+    raise HTTPException(status_code=404, detail="Instance not found")
 
 @app.post("/terminate/{instance_id}")
 def terminate_instance(instance_id: int, user: User = Depends(get_user_by_token)):
@@ -557,8 +1137,11 @@ def terminate_instance(instance_id: int, user: User = Depends(get_user_by_token)
             raise HTTPException(status_code=404, detail="Instance not found")
         if inst.user_id != user.id:
             raise HTTPException(status_code=403, detail="Forbidden")
-        inst.status = "terminated"
+        if inst.status != "terminated":
+            inst.status = "terminated"
+            inst.terminated_at = datetime.utcnow()
         session.add(inst); session.commit()
+        mark_user_write(user.id)
         return {"status": "terminated"}
 
 # ---------------------------
@@ -570,16 +1153,54 @@ def admin_auth(token: Optional[str] = Header(None)):
 
 @app.get("/admin/instances")
 def admin_list_instances(_=Depends(admin_auth)):
-    with Session(engine) as session:
+    with read_session() as session:
         rows = session.exec(select(Instance)).all()
         return {"instances": [r.dict() for r in rows]}
 
 @app.get("/admin/wallets")
 def admin_wallets(_=Depends(admin_auth)):
-    with Session(engine) as session:
+    with read_session() as session:
         rows = session.exec(select(WalletBalance)).all()
         return {"wallets": [r.dict() for r in rows]}
 
+@app.get("/admin/reconcile")
+def admin_reconcile_status(_=Depends(admin_auth)):
+    return {"reconciliation": _recon_metrics}
+
+@app.post("/admin/reconcile")
+def admin_reconcile_run(_=Depends(admin_auth)):
+    return {"reconciliation": run_reconciliation()}
+
+@app.get("/admin/archive/instances")
+def admin_archived_instances(user_id: Optional[int] = None, limit: int = 100, offset: int = 0, _=Depends(admin_auth)):
+    with read_session() as session:
+        q = select(InstanceArchive)
+        if user_id is not None:
+            q = q.where(InstanceArchive.user_id == user_id)
+        rows = session.exec(q.order_by(InstanceArchive.id.desc()).offset(max(0, offset)).limit(max(1, min(limit, 1000)))).all()
+        return {"instances": [r.dict() for r in rows]}
+
+@app.get("/admin/archive/transactions")
+def admin_archived_transactions(user_id: Optional[int] = None, limit: int = 100, offset: int = 0, _=Depends(admin_auth)):
+    with read_session() as session:
+        q = select(WalletTransactionArchive)
+        if user_id is not None:
+            q = q.where(WalletTransactionArchive.user_id == user_id)
+        rows = session.exec(q.order_by(WalletTransactionArchive.id.desc()).offset(max(0, offset)).limit(max(1, min(limit, 1000)))).all()
+        return {"transactions": [r.dict() for r in rows]}
+
+@app.get("/admin/archive")
+def admin_archive_status(_=Depends(admin_auth)):
+    return {"archive": _archive_metrics}
+
+@app.post("/admin/archive")
+def admin_archive_run(_=Depends(admin_auth)):
+    return {"archive": run_archive()}
+
+@app.post("/admin/referrals/rebuild")
+def admin_referrals_rebuild(_=Depends(admin_auth)):
+    return {"referrers": rebuild_referral_stats()}
+
 # ---------------------------
 # Global exception handler
 # ---------------------------
@@ -612,6 +1233,8 @@ def index():
             "GET /wallet (auth Bearer user-<id>)",
             "POST /wallet/create-order {amount} (auth)",
             "POST /webhook/razorpay (RAZORPAY webhook)",
-            "POST /webhook/simulate {user_id,amount} (dev only)"
+            "POST /webhook/simulate {user_id,amount} (dev only)",
+            "GET /referrals/me (auth)",
+            "GET /referrals/leaderboard?limit=10 (auth)"
         ]
     }